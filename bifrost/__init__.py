@@ -141,7 +141,19 @@ def create_app(config_class):
     app.json_provider_class = CustomJSONProvider
     app.json = app.json_provider_class(app)
 
-    mongo.init_app(app)
+    # Refuse to start without keys for the stored OTP and client secret hashes
+    from .utils.security import set_otp_pepper, set_client_secret_pepper, set_password_hash_method
+    set_otp_pepper(app.config.get('OTP_PEPPER'))
+    set_client_secret_pepper(app.config.get('CLIENT_SECRET_PEPPER'))
+    set_password_hash_method(app.config.get('PASSWORD_HASH_METHOD'))
+
+    from .models import MONGO_CLIENT_OPTIONS
+    mongo.init_app(
+        app,
+        maxPoolSize=app.config['MONGO_MAX_POOL_SIZE'],
+        minPoolSize=app.config['MONGO_MIN_POOL_SIZE'],
+        **MONGO_CLIENT_OPTIONS
+    )
 
     # --- ACTIVATE DYNAMIC CORS ---
     # Replaces static Flask-CORS configuration
@@ -2,13 +2,12 @@
 from flask import session, redirect, url_for, request, flash
 from flask_admin import Admin, AdminIndexView, expose
 from flask_admin.contrib.pymongo import ModelView
-from werkzeug.security import check_password_hash, generate_password_hash
+from .utils.security import hash_password, check_password, hash_client_secret
 from wtforms import form, fields, validators
 import secrets
-from datetime import datetime
-from zoneinfo import ZoneInfo
+from datetime import datetime, timezone
 
-UTC = ZoneInfo("UTC")
+UTC = timezone.utc
 
 
 # --- Forms ---
@@ -66,7 +65,7 @@ class BifrostAdminIndexView(AdminIndexView):
             db_name = self.admin.app.config.get('DB_NAME', 'bifrost_db')
             admin = mongo[db_name].admins.find_one({"email": form.email.data})
 
-            if admin and check_password_hash(admin['password_hash'], form.password.data):
+            if admin and check_password(admin['password_hash'], form.password.data):
                 session['is_admin'] = True
                 return redirect(url_for('.index'))
 
@@ -99,7 +98,7 @@ class ApplicationsView(SecureModelView):
             model['client_id'] = f"{safe_name}_{secrets.token_hex(4)}"
 
             raw_secret = secrets.token_urlsafe(32)
-            model['client_secret_hash'] = generate_password_hash(raw_secret)
+            model['client_secret_hash'] = hash_client_secret(raw_secret)
             model['created_at'] = datetime.now(UTC)
 
             methods = form.allowed_auth_methods.data.split(',')
@@ -134,7 +133,7 @@ class SuperAdminsView(SecureModelView):
     def on_model_change(self, form, model, is_created):
         if is_created:
             if form.password.data:
-                model['password_hash'] = generate_password_hash(form.password.data)
+                model['password_hash'] = hash_password(form.password.data)
             model['created_at'] = datetime.now(UTC)
 
 
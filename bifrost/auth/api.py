@@ -1,19 +1,20 @@
 from flask import Blueprint, request, jsonify, current_app
-from datetime import datetime
-from zoneinfo import ZoneInfo
+from datetime import datetime, timezone
 import jwt
-from werkzeug.security import check_password_hash
+from pymongo.errors import DuplicateKeyError
+from ..utils.security import check_password
 import logging
 from bson import ObjectId
 from bot.main import process_webhook_update
 import asyncio
 from .. import mongo
 from ..models import BifrostDB
+from ..models.auth import duplicate_field
 from ..services.email_service import send_otp_email
 from ..utils.telegram import verify_telegram_data
 
 auth_api_bp = Blueprint('auth_api', __name__, url_prefix='/auth/api')
-UTC_TZ = ZoneInfo("UTC")
+UTC_TZ = timezone.utc
 log = logging.getLogger(__name__)
 
 
@@ -95,7 +96,7 @@ def verify_email_otp():
     # 1. Lookup OTP Record (Safe peek)
     try:
         # Use ObjectId directly from bson import
-        oid = db.db.verification_codes.find_one({"_id": ObjectId(verification_id)})
+        oid = db.db.verification_codes.find_one({"_id": ObjectId(verification_id)}, {"identifier": 1})
     except Exception as e:
         log.error(f"Error looking up verification ID: {e}")
         return jsonify({"error": "Invalid verification ID format"}), 400
@@ -164,34 +165,39 @@ def complete_registration():
         return jsonify({"error": "Invalid or expired proof token"}), 403
 
     db = BifrostDB(mongo.cx, current_app.config['DB_NAME'])
-    app_config = db.get_app_by_client_id(client_id)
+    app_config = db.get_app_by_client_id(client_id, projection={"_id": 1})
     if not app_config:
         return jsonify({"error": "Invalid client_id"}), 401
 
-    # 2. Check Username Uniqueness if provided
-    if username and db.find_account_by_username(username):
-        return jsonify({"error": "Username already taken"}), 409
-
-    # 3. Create or Update Account
-    existing_user = db.find_account_by_email(email)
-
-    if existing_user:
-        db.update_password(email, password)
-        # If updating, optionally set username if not set? 
-        # For safety, we only set username on creation or explicit profile update,
-        # but here we can allow it if the user doesn't have one.
-        if username and not existing_user.get('username'):
-            db.db.accounts.update_one({"_id": existing_user['_id']}, {"$set": {"username": username.lower()}})
+    # 2 & 3. Create or Update Account
+    # Username uniqueness is enforced by the unique index; a collision surfaces
+    # as DuplicateKeyError on the write itself (no racy pre-check round-trip).
+    existing_user = db.find_account_by_email(email, fresh=True)
 
-        user_id = existing_user['_id']
-    else:
-        user_id = db.create_account({
-            "email": email,
-            "username": username,
-            "password": password,
-            "display_name": display_name or username or email.split('@')[0],
-            "auth_providers": ["email"]
-        })
+    try:
+        if existing_user:
+            # If updating, optionally set username if not set?
+            # For safety, we only set username on creation or explicit profile update,
+            # but here we can allow it if the user doesn't have one.
+            # Written before the password so a taken username leaves the account untouched.
+            if username and not existing_user.get('username'):
+                db.db.accounts.update_one({"_id": existing_user['_id']}, {"$set": {"username": username.lower()}})
+                db.forget_account(existing_user['_id'])
+            db.update_password(email, password)
+
+            user_id = existing_user['_id']
+        else:
+            user_id = db.create_account({
+                "email": email,
+                "username": username,
+                "password": password,
+                "display_name": display_name or username or email.split('@')[0],
+                "auth_providers": ["email"]
+            })
+    except DuplicateKeyError as e:
+        if duplicate_field(e) == 'username':
+            return jsonify({"error": "Username already taken"}), 409
+        return jsonify({"error": "Account already exists"}), 409
 
     # 4. Link User to App
     db.link_user_to_app(user_id, app_config['_id'])
@@ -269,23 +275,25 @@ def login():
         return jsonify({"error": "Missing credentials"}), 400
 
     db = BifrostDB(mongo.cx, current_app.config['DB_NAME'])
-    app_config = db.get_app_by_client_id(client_id)
+    app_config = db.get_app_by_client_id(client_id, projection={"_id": 1})
 
     if not app_config:
         return jsonify({"error": "Invalid client_id"}), 401
 
-    # Try finding by email first, then username
-    user = db.find_account_by_email(identifier)
+    # Try finding by email first, then username (fresh: password/is_active gate the login)
+    user = db.find_account_by_email(identifier, fresh=True)
     if not user:
-        user = db.find_account_by_username(identifier)
+        user = db.find_account_by_username(identifier, fresh=True)
 
     # Validate Password
-    if not user or not user.get('password_hash') or not check_password_hash(user['password_hash'], password):
+    if not user or not user.get('password_hash') or not check_password(user['password_hash'], password):
         return jsonify({"error": "Invalid credentials"}), 401
 
     if not user.get('is_active', True):
         return jsonify({"error": "Account is disabled"}), 403
 
+    db.upgrade_password_hash(user, password)
+
     # Link User to App
     db.link_user_to_app(user['_id'], app_config['_id'])
 
@@ -321,7 +329,7 @@ def verify_otp_login():
         return jsonify({"error": "Missing client_id or code"}), 400
 
     db = BifrostDB(mongo.cx, current_app.config['DB_NAME'])
-    app_config = db.get_app_by_client_id(client_id)
+    app_config = db.get_app_by_client_id(client_id, projection={"_id": 1})
 
     if not app_config:
         return jsonify({"error": "Invalid client_id"}), 401
@@ -333,7 +341,7 @@ def verify_otp_login():
         return jsonify({"error": "Invalid or expired code"}), 401
 
     # Find or Create Account
-    user = db.find_account_by_telegram(telegram_id)
+    user = db.find_account_by_telegram(telegram_id, fresh=True)
 
     if not user:
         user_id = db.create_account({
@@ -392,7 +400,7 @@ def telegram_login():
         return jsonify({"error": "Authentication verification failed"}), 401
 
     telegram_id = str(tg_data['id'])
-    user = db.find_account_by_telegram(telegram_id)
+    user = db.find_account_by_telegram(telegram_id, fresh=True)
 
     if not user:
         user_id = db.create_account({
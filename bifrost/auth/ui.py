@@ -1,14 +1,13 @@
 from flask import Blueprint, render_template, request, redirect, flash, current_app, url_for, session
-from werkzeug.security import check_password_hash
+from ..utils.security import check_password
 import jwt
 import datetime
-from zoneinfo import ZoneInfo
 from .. import mongo
 from ..models import BifrostDB
 from ..services.email_service import send_otp_email
 
 auth_ui_bp = Blueprint('auth_ui', __name__, url_prefix='/auth/ui')
-UTC = ZoneInfo("UTC")
+UTC = datetime.timezone.utc
 
 def get_app_config(client_id):
     """Helper to fetch App configuration and DB instance."""
@@ -47,11 +46,12 @@ def login():
         identifier = request.form.get('email')
         password = request.form.get('password')
 
-        user = db.find_account_by_email(identifier)
+        user = db.find_account_by_email(identifier, fresh=True)
         if not user:
-            user = db.find_account_by_username(identifier)
+            user = db.find_account_by_username(identifier, fresh=True)
 
-        if user and user.get('password_hash') and check_password_hash(user['password_hash'], password):
+        if user and user.get('password_hash') and check_password(user['password_hash'], password):
+            db.upgrade_password_hash(user, password)
             db.link_user_to_app(user['_id'], app_config['_id'])
             token = create_session_token(user, client_id)
             callback_url = app_config.get('app_callback_url')
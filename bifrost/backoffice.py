@@ -1,9 +1,9 @@
 # bifrost/backoffice.py
 from flask import Blueprint, render_template, request, redirect, url_for, session, flash, current_app, jsonify
-from werkzeug.security import check_password_hash, generate_password_hash
-from bson import ObjectId
+from .utils.security import hash_password, check_password
 from . import mongo
 from .models import BifrostDB
+from .models.base import to_object_id, CASE_INSENSITIVE
 from .services.email_service import send_invite_email, send_reset_email
 
 backoffice_bp = Blueprint('backoffice', __name__, url_prefix='/backoffice')
@@ -80,7 +80,7 @@ def login():
 
         # 1. Heimdall Check
         admin_doc = db.db.admins.find_one({"email": identifier.lower()})
-        if admin_doc and check_password_hash(admin_doc['password_hash'], password):
+        if admin_doc and check_password(admin_doc['password_hash'], password):
             if admin_doc.get('role') == 'heimdall':
                 session['backoffice_user'] = str(admin_doc['_id'])
                 session['is_heimdall'] = True
@@ -90,10 +90,11 @@ def login():
                 flash("Role deprecated. Update to 'heimdall'.", "warning")
 
         # 2. App Tenant Check
-        user = db.find_account_by_email(identifier)
-        if not user: user = db.find_account_by_username(identifier)
+        user = db.find_account_by_email(identifier, fresh=True)
+        if not user: user = db.find_account_by_username(identifier, fresh=True)
 
-        if user and user.get('password_hash') and check_password_hash(user['password_hash'], password):
+        if user and user.get('password_hash') and check_password(user['password_hash'], password):
+            db.upgrade_password_hash(user, password)
             managed_apps = db.get_managed_apps(user['_id'])
             if managed_apps:
                 session['backoffice_user'] = str(user['_id'])
@@ -151,12 +152,16 @@ def reset_password():
         db = get_db()
 
         if db.verify_otp(email, otp_input):
-            hashed = generate_password_hash(new_password)
+            hashed = hash_password(new_password)
             is_heimdall = session.get('reset_is_heimdall')
             if is_heimdall:
                 db.db.admins.update_one({"email": email}, {"$set": {"password_hash": hashed}})
             else:
-                db.db.accounts.update_one({"email": email}, {"$set": {"password_hash": hashed}})
+                account = db.db.accounts.find_one_and_update(
+                    {"email": email}, {"$set": {"password_hash": hashed}}, projection={"_id": 1},
+                    collation=CASE_INSENSITIVE)
+                if account:
+                    db.forget_account(account['_id'])
 
             session.pop('reset_email', None)
             flash("Password updated.", "success")
@@ -207,7 +212,7 @@ def get_global_user_details(user_id):
     user = db.find_account_by_id(user_id)
     if not user: return jsonify({"error": "User not found"}), 404
 
-    links = list(db.db.app_links.find({"account_id": ObjectId(user_id)}))
+    links = list(db.db.app_links.find({"account_id": to_object_id(user_id)}))
     linked_apps = []
     for link in links:
         app = db.db.applications.find_one({"_id": link['app_id']})
@@ -223,8 +228,9 @@ def get_global_user_details(user_id):
 def delete_global_user(user_id):
     db = get_db()
     try:
-        db.db.app_links.delete_many({"account_id": ObjectId(user_id)})
-        db.db.accounts.delete_one({"_id": ObjectId(user_id)})
+        db.db.app_links.delete_many({"account_id": to_object_id(user_id)})
+        db.db.accounts.delete_one({"_id": to_object_id(user_id)})
+        db.forget_account(user_id)
         flash("User deleted.", "warning")
     except Exception as e:
         flash(f"Error: {e}", "danger")
@@ -271,7 +277,7 @@ def view_app(app_id):
         flash("Unauthorized.", "danger")
         return redirect(url_for('backoffice.dashboard'))
 
-    app = db.db.applications.find_one({"_id": ObjectId(app_id)})
+    app = db.db.applications.find_one({"_id": to_object_id(app_id)})
     users = db.get_app_users(app_id)
     owner = db.get_app_owner(app_id)
     current_role = get_current_role_in_app(app_id)
@@ -349,7 +355,7 @@ def add_user_to_app(app_id):
     email = request.form.get('email').strip().lower()
     duration = request.form.get('duration')
 
-    app = db.db.applications.find_one({"_id": ObjectId(app_id)})
+    app = db.db.applications.find_one({"_id": to_object_id(app_id)})
     user = db.find_account_by_email(email)
 
     if not user:
@@ -132,7 +132,7 @@ def validate_token():
         if not app_doc:
             return jsonify({"is_valid": False, "error": "App not found"}), 500
 
-        user = db.find_account_by_id(account_id)
+        user = db.find_account_by_id(account_id, fresh=True)
         if not user or not user.get('is_active', True):
             return jsonify({"is_valid": False, "error": "User inactive or not found"}), 403
 
@@ -5,10 +5,20 @@ from .payments import PaymentMixin
 from werkzeug.local import LocalProxy
 from flask import current_app
 
+# Timeout bounds for every MongoClient (web and bot). pymongo's own defaults leave
+# them effectively unbounded, so a stalled primary pins request threads. Pool sizes
+# come from config.MONGO_MAX_POOL_SIZE / MONGO_MIN_POOL_SIZE.
+MONGO_CLIENT_OPTIONS = {
+    "waitQueueTimeoutMS": 2000,
+    "serverSelectionTimeoutMS": 3000,
+    "socketTimeoutMS": 10000,
+    "retryWrites": True,
+}
+
 class BifrostDB(BaseMixin, AuthMixin, AppMixin, PaymentMixin):
     """
     Central Database Manager for Bifrost.
     Combines functionality from Auth, Apps, and Payment mixins.
     """
     def __init__(self, mongo_client, db_name):
-        super().__init__(mongo_client, db_name)
\ No newline at end of file
+        super().__init__(mongo_client, db_name)
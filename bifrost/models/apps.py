@@ -1,13 +1,48 @@
 # bifrost/models/apps.py
 import secrets
-from datetime import datetime, timedelta
-from zoneinfo import ZoneInfo
-from bson import ObjectId
-from werkzeug.security import generate_password_hash, check_password_hash
+from functools import lru_cache
+from datetime import datetime, timezone
+from pymongo import ReturnDocument
+from .base import to_object_id, DURATION_TABLE
+from ..utils.security import check_password, hash_client_secret, is_client_secret_hash, check_client_secret
+from ..utils.cache import TTLCache
 import logging
 
 log = logging.getLogger(__name__)
-UTC = ZoneInfo("UTC")
+UTC = timezone.utc
+
+# Fields the dashboard listings actually render; keeps secrets/hashes off the wire.
+APP_SUMMARY_PROJECTION = {
+    "app_name": 1, "client_id": 1, "app_logo_url": 1, "app_web_url": 1, "app_callback_url": 1
+}
+
+# client_id -> application document without its secrets. Apps change rarely but
+# are read on nearly every API call; writes through this mixin evict the entry.
+_APPS_BY_CLIENT_ID = TTLCache(maxsize=1024, ttl=60)
+
+# Never held in the cache; callers that need them name them in the projection
+_APP_SECRET_FIELDS = ("client_secret_hash", "webhook_secret")
+
+
+@lru_cache(maxsize=1)
+def _unknown_client_hash():
+    # Compared against for unknown client_ids so a miss costs the same as a wrong secret.
+    # Built on first use: the pepper is only installed by create_app().
+    return hash_client_secret(secrets.token_urlsafe(32))
+
+
+def _project(doc, projection):
+    """Applies an inclusion projection ({field: 1}, optional "_id": 0) to a cached document."""
+    if projection is None:
+        return dict(doc)
+    fields = {field for field, include in projection.items() if include}
+    if projection.get("_id", 1):
+        fields.add("_id")
+    return {field: doc[field] for field in fields if field in doc}
+
+
+def _forget_app(client_id):
+    _APPS_BY_CLIENT_ID.pop(client_id)
 
 
 class AppMixin:
@@ -25,7 +60,7 @@ class AppMixin:
         app_doc = {
             "app_name": app_name,
             "client_id": client_id,
-            "client_secret_hash": generate_password_hash(client_secret),
+            "client_secret_hash": hash_client_secret(client_secret),
             "webhook_secret": webhook_secret,
             "app_logo_url": logo_url or "",
             "app_qr_url": "",
@@ -50,90 +85,115 @@ class AppMixin:
         updates = {k: v for k, v in data.items() if k in allowed_fields}
 
         if updates:
-            self.db.applications.update_one(
-                {"_id": ObjectId(app_id)},
-                {"$set": updates}
+            app = self.db.applications.find_one_and_update(
+                {"_id": to_object_id(app_id)},
+                {"$set": updates},
+                projection={"client_id": 1, "_id": 0}
             )
+            if app:
+                _forget_app(app.get('client_id'))
             return True
         return False
 
     def rotate_app_secret(self, app_id):
         """Regenerates the Client Secret for an App."""
         new_secret = secrets.token_urlsafe(32)
-        self.db.applications.update_one(
-            {"_id": ObjectId(app_id)},
-            {"$set": {"client_secret_hash": generate_password_hash(new_secret)}}
+        app = self.db.applications.find_one_and_update(
+            {"_id": to_object_id(app_id)},
+            {"$set": {"client_secret_hash": hash_client_secret(new_secret)}},
+            projection={"client_id": 1, "_id": 0}
         )
+        if app:
+            _forget_app(app.get('client_id'))
         return new_secret
 
-    def get_app_by_client_id(self, client_id):
-        return self.db.applications.find_one({"client_id": client_id})
+    def get_app_by_client_id(self, client_id, projection=None):
+        # The cache holds whole documents minus the secrets (apps are small), so
+        # projected callers are served from it too; the projection is applied on
+        # the way out. Asking for a secret field by projection reads Mongo directly.
+        if projection and any(projection.get(field) for field in _APP_SECRET_FIELDS):
+            return self.db.applications.find_one({"client_id": client_id}, projection)
+        app = _APPS_BY_CLIENT_ID.get(client_id)
+        if app is None:
+            app = self.db.applications.find_one(
+                {"client_id": client_id}, {field: 0 for field in _APP_SECRET_FIELDS}
+            )
+            if app is None:
+                return None
+            _APPS_BY_CLIENT_ID.set(client_id, app)
+        return _project(app, projection)
 
     def verify_client_secret(self, client_id, provided_secret):
-        app = self.get_app_by_client_id(client_id)
+        if not provided_secret:
+            return False
+        # Always read from Mongo: a rotated secret must stop working in every process at once
+        app = self.db.applications.find_one({"client_id": client_id}, {"client_secret_hash": 1})
         if not app:
+            check_client_secret(_unknown_client_hash(), provided_secret)
             return False
-        return check_password_hash(app["client_secret_hash"], provided_secret)
+        secret_hash = app["client_secret_hash"]
+        if not is_client_secret_hash(secret_hash):
+            # Legacy KDF hash: verify the slow way once, then migrate to the keyed hash
+            if not check_password(secret_hash, provided_secret):
+                return False
+            self.db.applications.update_one(
+                {"_id": app["_id"], "client_secret_hash": secret_hash},
+                {"$set": {"client_secret_hash": hash_client_secret(provided_secret)}}
+            )
+            return True
+        return check_client_secret(secret_hash, provided_secret)
 
     def link_user_to_app(self, account_id, app_id, role="user", duration_str=None, suppress_webhook=False):
         """
         Links a user to an app.
         STRICT: Writes to app_specific_role only.
         """
+        account_oid = to_object_id(account_id)
+        app_oid = to_object_id(app_id)
+        now = datetime.now(UTC)
+
         # --- OWNER LOGIC: Enforce Single Owner ---
         if role == 'owner':
-            existing_owners = self.db.app_links.find({
-                "app_id": ObjectId(app_id),
+            owner_query = {
+                "app_id": app_oid,
                 "app_specific_role": "owner",
-                "account_id": {"$ne": ObjectId(account_id)}
-            })
-
-            for owner_link in existing_owners:
-                log.info(f"👑 Ownership Transfer: Demoting {owner_link['account_id']} to Super Admin.")
-                # Downgrade previous owner to Super Admin
-                self.link_user_to_app(
-                    account_id=owner_link['account_id'],
-                    app_id=app_id,
-                    role="super_admin",
-                    duration_str="lifetime",
-                    suppress_webhook=False
+                "account_id": {"$ne": account_oid}
+            }
+            demoted = [link['account_id'] for link in self.db.app_links.find(owner_query, {"account_id": 1, "_id": 0})]
+            if demoted:
+                # Downgrade previous owners to Super Admin in one write
+                self.db.app_links.update_many(
+                    {**owner_query, "account_id": {"$in": demoted}},
+                    {"$set": {"app_specific_role": "super_admin", "expires_at": None, "last_login": now}}
                 )
+                for demoted_id in demoted:
+                    log.info(f"👑 Ownership Transfer: Demoted {demoted_id} to Super Admin.")
+                    self._trigger_event_for_user(demoted_id, "account_role_change", specific_app_id=app_id)
         # ------------------------------------------
-
-        current_link = self.db.app_links.find_one({"account_id": ObjectId(account_id), "app_id": ObjectId(app_id)})
-        old_role = current_link.get('app_specific_role') if current_link else None
-
         update_doc = {
-            "last_login": datetime.now(UTC),
+            "last_login": now,
             "app_specific_role": role  # <--- STRICT WRITE
         }
 
-        if duration_str and duration_str != 'lifetime':
-            now = datetime.now(UTC)
-            expires_at = None
-            if duration_str == '1m':
-                expires_at = now + timedelta(days=30)
-            elif duration_str == '3m':
-                expires_at = now + timedelta(days=90)
-            elif duration_str == '6m':
-                expires_at = now + timedelta(days=180)
-            elif duration_str == '1y':
-                expires_at = now + timedelta(days=365)
-
-            if expires_at:
-                update_doc["expires_at"] = expires_at
-
         if duration_str == 'lifetime':
             update_doc["expires_at"] = None
-
-        self.db.app_links.update_one(
-            {"account_id": ObjectId(account_id), "app_id": ObjectId(app_id)},
+        else:
+            delta = DURATION_TABLE.get(duration_str)
+            if delta is not None:
+                update_doc["expires_at"] = now + delta
+
+        # Single round-trip: upsert and read back the pre-update role atomically
+        previous_link = self.db.app_links.find_one_and_update(
+            {"account_id": account_oid, "app_id": app_oid},
             {
                 "$set": update_doc,
-                "$setOnInsert": {"linked_at": datetime.now(UTC)}
+                "$setOnInsert": {"linked_at": now}
             },
-            upsert=True
+            projection={"app_specific_role": 1, "_id": 0},
+            upsert=True,
+            return_document=ReturnDocument.BEFORE
         )
+        old_role = previous_link.get('app_specific_role') if previous_link else None
 
         if old_role != role and not suppress_webhook:
             self._trigger_event_for_user(account_id, "account_role_change", specific_app_id=app_id)
@@ -144,11 +204,11 @@ class AppMixin:
         Verified users (user, premium_user, admin) cannot be removed by anyone except themselves.
         """
         query = {
-            "account_id": ObjectId(account_id),
-            "app_id": ObjectId(app_id)
+            "account_id": to_object_id(account_id),
+            "app_id": to_object_id(app_id)
         }
 
-        link = self.db.app_links.find_one(query)
+        link = self.db.app_links.find_one(query, {"app_specific_role": 1, "_id": 0})
         if not link:
             return False, "Link not found."
 
@@ -173,87 +233,92 @@ class AppMixin:
 
     def get_user_role_for_app(self, account_id, app_id):
         log.info(f"🔍 DEBUG: Checking role for Account {account_id} in App {app_id}")
-        link = self.db.app_links.find_one({"account_id": ObjectId(account_id), "app_id": ObjectId(app_id)})
+        # STRICT READ: We ONLY check app_specific_role.
+        # Expiry is resolved server-side against $$NOW (BSON dates are always UTC).
+        links = self.db.app_links.aggregate([
+            {"$match": {"account_id": to_object_id(account_id), "app_id": to_object_id(app_id)}},
+            {"$limit": 1},
+            {"$project": {
+                "_id": 0,
+                "role": {"$cond": [
+                    # Lifetime links (null/missing expires_at) never compare as lapsed
+                    {"$lt": [{"$ifNull": ["$expires_at", datetime.max]}, "$$NOW"]},
+                    "expired",
+                    {"$ifNull": ["$app_specific_role", "user"]}
+                ]}
+            }}
+        ])
+        link = next(links, None)
 
         if not link:
             log.info(f"❌ DEBUG: No App Link found for Account {account_id}. Defaulting to None.")
             return None
 
-        # STRICT READ: We ONLY check app_specific_role.
-        role = link.get('app_specific_role', 'user')
-        expires_at = link.get('expires_at')
-
-        log.info(f"📄 DEBUG: Found Link: Role='{role}', Expires={expires_at}")
-
-        if expires_at:
-            # Ensure timezone awareness for accurate comparison
-            now = datetime.now(UTC)
-            # Handle case where stored date might be naive (older data) or aware
-            if expires_at.tzinfo is None:
-                expires_at = expires_at.replace(tzinfo=UTC)
-            else:
-                expires_at = expires_at.astimezone(UTC)
-
-            log.info(f"⏳ DEBUG: Expiration Check: Now={now} vs Expires={expires_at}")
-
-            if expires_at < now:
-                log.info("🚫 DEBUG: Subscription EXPIRED")
-                return "expired"
-
-        return role
+        log.info(f"📄 DEBUG: Found Link: Role='{link['role']}'")
+        return link['role']
 
     # ---------------------------------------------------------
     # BACKOFFICE & HEIMDALL HELPERS
     # ---------------------------------------------------------
     def is_heimdall(self, email):
         if not email: return False
-        admin = self.db.admins.find_one({"email": email.lower()})
+        admin = self.db.admins.find_one({"email": email.lower()}, {"role": 1, "_id": 0})
         return admin and admin.get('role') == 'heimdall'
 
     def get_managed_apps(self, account_id):
         """Returns apps where user is admin, super_admin, or owner."""
         # STRICT: check app_specific_role
-        links = self.db.app_links.find({
-            "account_id": ObjectId(account_id),
-            "app_specific_role": {"$in": ["admin", "super_admin", "owner"]}
-        })
-        app_ids = [link['app_id'] for link in links]
-        return list(self.db.applications.find({"_id": {"$in": app_ids}}))
+        # One round-trip: join the user's staff links to their applications server-side
+        return list(self.db.app_links.aggregate([
+            {"$match": {
+                "account_id": to_object_id(account_id),
+                "app_specific_role": {"$in": ["admin", "super_admin", "owner"]}
+            }},
+            {"$lookup": {
+                "from": "applications",
+                "localField": "app_id",
+                "foreignField": "_id",
+                "as": "app"
+            }},
+            {"$unwind": "$app"},
+            {"$replaceRoot": {"newRoot": "$app"}},
+            {"$project": APP_SUMMARY_PROJECTION}
+        ]))
 
     def get_all_apps(self):
-        return list(self.db.applications.find({}))
+        return list(self.db.applications.find({}, APP_SUMMARY_PROJECTION))
 
     def get_app_users(self, app_id):
-        links = list(self.db.app_links.find({"app_id": ObjectId(app_id)}))
-        if not links:
-            return []
-
-        user_ids = [link['account_id'] for link in links]
-        users_cursor = self.db.accounts.find({"_id": {"$in": user_ids}})
-        users_map = {u['_id']: u for u in users_cursor}
-
-        results = []
-        for link in links:
-            user = users_map.get(link['account_id'])
-            if user:
-                # MAPPING: We read 'app_specific_role' but return it as 'role' key
-                # for API backward compatibility, assuming frontend expects 'role'.
-                results.append({
-                    "account_id": str(user['_id']),
-                    "display_name": user.get('display_name'),
-                    "email": user.get('email'),
-                    "username": user.get('username'),
-                    "telegram_id": user.get('telegram_id'),
-                    "role": link.get('app_specific_role', 'user'),
-                    "expires_at": link.get('expires_at'),
-                    "linked_at": link.get('linked_at')
-                })
-        return results
+        # Server-side join; the cursor yields already-merged rows.
+        # MAPPING: We read 'app_specific_role' but return it as 'role' key
+        # for API backward compatibility, assuming frontend expects 'role'.
+        pipeline = [
+            {"$match": {"app_id": to_object_id(app_id)}},
+            {"$lookup": {
+                "from": "accounts",
+                "localField": "account_id",
+                "foreignField": "_id",
+                "as": "user"
+            }},
+            {"$unwind": "$user"},
+            {"$project": {
+                "_id": 0,
+                "account_id": {"$toString": "$user._id"},
+                "display_name": "$user.display_name",
+                "email": "$user.email",
+                "username": "$user.username",
+                "telegram_id": "$user.telegram_id",
+                "role": {"$ifNull": ["$app_specific_role", "user"]},
+                "expires_at": 1,
+                "linked_at": 1
+            }}
+        ]
+        return list(self.db.app_links.aggregate(pipeline))
 
     def get_app_owner(self, app_id):
         # STRICT: check app_specific_role
         link = self.db.app_links.find_one({
-            "app_id": ObjectId(app_id),
+            "app_id": to_object_id(app_id),
             "app_specific_role": "owner"
         })
         if link:
@@ -1,13 +1,51 @@
-import random
+import re
 import secrets
-from datetime import datetime
-from zoneinfo import ZoneInfo
+from datetime import datetime, timezone
 from bson import ObjectId
-from werkzeug.security import generate_password_hash
+from .base import to_object_id, strip_whitespace, CASE_INSENSITIVE
+from pymongo import DeleteMany, InsertOne
+from pymongo.write_concern import WriteConcern
+from pymongo.errors import DuplicateKeyError
+from ..utils.security import hash_password, needs_rehash, hash_otp
+from ..utils.cache import TTLCache
 import logging
 
 log = logging.getLogger(__name__)
-UTC = ZoneInfo("UTC")
+UTC = timezone.utc
+
+# Process-local read-through cache for account lookups.
+# Documents are keyed by account id; email/username/telegram_id map to that id,
+# so invalidating the id (forget_account) is enough after any write.
+_ACCOUNTS = TTLCache(maxsize=10_000, ttl=30)
+_ACCOUNT_KEYS = TTLCache(maxsize=30_000, ttl=30)
+_ACCOUNT_LOOKUP_FIELDS = ("email", "username", "telegram_id")
+# Codes/tokens are ephemeral (TTL-deleted after 10 minutes), so skip the journal wait
+_OTP_WRITE_CONCERN = WriteConcern(w=1, j=False)
+
+# Fields callers read off a consumed verification record
+_OTP_RECORD_FIELDS = {"identifier": 1, "channel": 1, "account_id": 1}
+
+
+def _lookup_key(field, value):
+    value = str(value)
+    return field, value.lower() if field in ("email", "username") else value
+
+
+def duplicate_field(error):
+    """Returns the field name that tripped a unique index on a DuplicateKeyError."""
+    details = error.details or {}
+    key_pattern = details.get('keyPattern') or details.get('keyValue') or {}
+    if key_pattern:
+        return next(iter(key_pattern))
+    # Older servers only report the index name in the message ("index: email_1 dup key")
+    match = re.search(r"index: (\w+?)_-?1", str(error))
+    return match.group(1) if match else None
+
+
+def _is_otp_code(code):
+    """True for the 6-digit shape create_otp issues; anything else can't match a stored code."""
+    return code is not None and len(code) == 6 and code.isascii() and code.isdigit()
+
 
 class AuthMixin:
     # ---------------------------------------------------------
@@ -20,16 +58,13 @@ class AuthMixin:
         user confusion (entering an old valid code vs a new valid code).
         """
         identifier = str(identifier).lower()
+        code = f"{secrets.randbelow(900_000) + 100_000:06d}"
+        otp_id = ObjectId()
+        collection = self.db.verification_codes.with_options(write_concern=_OTP_WRITE_CONCERN)
 
-        # 1. Invalidate previous codes for this specific flow to ensure only the LATEST works
-        self.db.verification_codes.delete_many({
-            "identifier": identifier,
-            "channel": channel
-        })
-
-        code = str(random.randint(100000, 999999))
         doc = {
-            "code": code,
+            "_id": otp_id,
+            "code": hash_otp(code),
             "identifier": identifier,
             "channel": channel,
             "created_at": datetime.now(UTC)
@@ -37,9 +72,16 @@ class AuthMixin:
         if account_id:
             doc["account_id"] = str(account_id)
 
-        result = self.db.verification_codes.insert_one(doc)
-        log.info(f"✅ OTP Created: Code={code}, Channel={channel}, ID={identifier}")
-        return code, str(result.inserted_id)
+        # Invalidate previous codes for this specific flow to ensure only the LATEST works,
+        # and store the new one, in one acknowledged round-trip: the code is only handed
+        # out once it is stored. Bounding the delete by _id keeps a concurrent request
+        # for the same identifier from deleting a newer code than its own.
+        collection.bulk_write([
+            DeleteMany({"identifier": identifier, "channel": channel, "_id": {"$lt": otp_id}}),
+            InsertOne(doc)
+        ], ordered=True)
+        log.info(f"✅ OTP Created: Channel={channel}, ID={identifier}")
+        return code, str(otp_id)
 
     def create_login_code(self, telegram_id):
         code, _ = self.create_otp(telegram_id, channel="telegram")
@@ -49,13 +91,13 @@ class AuthMixin:
         """Generates a secure, long-string token for Deep Linking."""
         token = secrets.token_urlsafe(16)
         doc = {
-            "code": token,
+            "code": hash_otp(token),
             "identifier": "deep_link",
             "account_id": str(account_id),
             "channel": "deep_link",
             "created_at": datetime.now(UTC)
         }
-        self.db.verification_codes.insert_one(doc)
+        self.db.verification_codes.with_options(write_concern=_OTP_WRITE_CONCERN).insert_one(doc)
         log.info(f"🔗 Deep Link Token Created for Account {account_id}")
         return token
 
@@ -64,9 +106,9 @@ class AuthMixin:
         Verifies and consumes an OTP.
         """
         # Aggressive cleaning: remove spaces, newlines, tabs
-        safe_code = "".join(str(code).split()) if code else None
+        safe_code = strip_whitespace(code)
 
-        query = {"code": safe_code}
+        query = {}
 
         if verification_id:
             try:
@@ -80,8 +122,16 @@ class AuthMixin:
         if not identifier and not verification_id and not safe_code:
             return False
 
+        # Identifier/verification_id flows only ever hold create_otp codes, so garbage
+        # input is rejected without a find_one_and_delete. A bare `code` may be a
+        # deep-link token and is looked up as-is.
+        if (identifier or verification_id) and not _is_otp_code(safe_code):
+            log.warning("❌ OTP Verification failed: code is not a 6-digit OTP")
+            return False
+        query["code"] = hash_otp(safe_code)
+
         # Atomic find and delete
-        record = self.db.verification_codes.find_one_and_delete(query)
+        record = self.db.verification_codes.find_one_and_delete(query, projection=_OTP_RECORD_FIELDS)
 
         if record:
             log.info(f"✅ OTP Verified and Consumed for {record.get('identifier')}")
@@ -91,10 +141,15 @@ class AuthMixin:
         return False
 
     def verify_and_consume_code(self, code):
-        safe_code = "".join(str(code).split()) if code else None
-        log.info(f"🔍 Attempting to verify Telegram code: '{safe_code}'")
-        query = {"code": safe_code, "channel": "telegram"}
-        record = self.db.verification_codes.find_one_and_delete(query)
+        safe_code = strip_whitespace(code)
+        log.info("🔍 Attempting to verify Telegram code")
+        if not _is_otp_code(safe_code):
+            return None
+        query = {"code": hash_otp(safe_code), "channel": "telegram"}
+        record = self.db.verification_codes.find_one_and_delete(
+            query,
+            projection={"identifier": 1, "_id": 0}
+        )
         if record:
             return record['identifier']
         return None
@@ -115,7 +170,7 @@ class AuthMixin:
         if data.get("username"):
             account["username"] = data.get("username").lower()
         if data.get("password"):
-            account["password_hash"] = generate_password_hash(data["password"])
+            account["password_hash"] = hash_password(data["password"])
         if data.get("telegram_id"):
             account["telegram_id"] = str(data.get("telegram_id"))
         if data.get("google_id"):
@@ -125,47 +180,110 @@ class AuthMixin:
 
         return self.db.accounts.insert_one(account).inserted_id
 
-    def find_account_by_email(self, email):
+    # ---------------------------------------------------------
+    # ACCOUNT LOOKUPS (cached)
+    # ---------------------------------------------------------
+    def _cached_account(self, field, value):
+        if field == "_id":
+            doc = _ACCOUNTS.get(str(value))
+        else:
+            key = _lookup_key(field, value)
+            account_id = _ACCOUNT_KEYS.get(key)
+            doc = _ACCOUNTS.get(account_id) if account_id else None
+            # The key map can outlive a change of the field itself
+            if doc is not None and _lookup_key(field, doc.get(field, "")) != key:
+                doc = None
+        return dict(doc) if doc is not None else None
+
+    def _remember_account(self, doc):
+        account_id = str(doc['_id'])
+        _ACCOUNTS.set(account_id, dict(doc))
+        for field in _ACCOUNT_LOOKUP_FIELDS:
+            if doc.get(field):
+                _ACCOUNT_KEYS.set(_lookup_key(field, doc[field]), account_id)
+
+    def forget_account(self, account_id):
+        """Drops an account from the read cache. Call after any write to `accounts`."""
+        _ACCOUNTS.pop(str(account_id), None)
+
+    def _find_account(self, field, value, query, projection=None, fresh=False, **kwargs):
+        # The cache is per process and forget_account only clears the local copy, so
+        # credential and is_active checks pass fresh=True to always read from Mongo.
+        if not fresh:
+            cached = self._cached_account(field, value)
+            if cached is not None:
+                return cached
+        doc = self.db.accounts.find_one(query, projection, **kwargs)
+        # Only full documents are cached; projected reads would poison other callers
+        if doc is not None and projection is None:
+            self._remember_account(doc)
+        return doc
+
+    # NOTE: Pass a `projection` when the caller only needs a few fields
+    # (e.g. existence checks only need {"_id": 1}), and `fresh=True` when the
+    # result gates access (password_hash, is_active).
+    def find_account_by_email(self, email, projection=None, fresh=False):
         if not email: return None
-        return self.db.accounts.find_one({"email": email.lower()})
+        return self._find_account("email", email, {"email": email}, projection, fresh,
+                                  collation=CASE_INSENSITIVE)
 
-    def find_account_by_username(self, username):
+    def find_account_by_username(self, username, projection=None, fresh=False):
         if not username: return None
-        return self.db.accounts.find_one({"username": username.lower()})
+        return self._find_account("username", username, {"username": username}, projection, fresh,
+                                  collation=CASE_INSENSITIVE)
 
-    def find_account_by_id(self, account_id):
+    def find_account_by_id(self, account_id, projection=None, fresh=False):
         try:
-            return self.db.accounts.find_one({"_id": ObjectId(account_id)})
+            return self._find_account("_id", account_id, {"_id": to_object_id(account_id)}, projection, fresh)
         except:
             return None
 
-    def find_account_by_telegram(self, telegram_id):
-        return self.db.accounts.find_one({"telegram_id": str(telegram_id)})
+    def find_account_by_telegram(self, telegram_id, projection=None, fresh=False):
+        return self._find_account("telegram_id", telegram_id, {"telegram_id": str(telegram_id)}, projection, fresh)
 
     def update_password(self, email, new_password):
-        user = self.find_account_by_email(email)
+        if not email:
+            return
+        # Single round-trip: write by email and read back only the _id for the webhook
+        user = self.db.accounts.find_one_and_update(
+            {"email": email},
+            {"$set": {"password_hash": hash_password(new_password)}},
+            projection={"_id": 1},
+            collation=CASE_INSENSITIVE
+        )
         if not user:
             return
 
+        self.forget_account(user['_id'])
+        self._trigger_event_for_user(user['_id'], "security_password_change")
+
+    def upgrade_password_hash(self, user, password):
+        """
+        Re-hashes a just-verified password if it was stored with an older method/cost.
+        Only call after check_password succeeded for `user`.
+        """
+        if not needs_rehash(user.get('password_hash')):
+            return
         self.db.accounts.update_one(
-            {"_id": user['_id']},
-            {"$set": {"password_hash": generate_password_hash(new_password)}}
+            {"_id": user['_id'], "password_hash": user['password_hash']},
+            {"$set": {"password_hash": hash_password(password)}}
         )
-        self._trigger_event_for_user(user['_id'], "security_password_change")
+        self.forget_account(user['_id'])
 
     def link_email_credentials(self, account_id, email, password):
         email = email.lower()
-        existing = self.db.accounts.find_one({"email": email, "_id": {"$ne": ObjectId(account_id)}})
-        if existing:
+        # The unique index on 'email' is the source of truth; no pre-check round-trip.
+        try:
+            result = self.db.accounts.update_one(
+                {"_id": to_object_id(account_id)},
+                {
+                    "$set": {"email": email, "password_hash": hash_password(password)},
+                    "$addToSet": {"auth_providers": "email"}
+                }
+            )
+        except DuplicateKeyError:
             return False, "Email is already associated with another account."
-
-        result = self.db.accounts.update_one(
-            {"_id": ObjectId(account_id)},
-            {
-                "$set": {"email": email, "password_hash": generate_password_hash(password)},
-                "$addToSet": {"auth_providers": "email"}
-            }
-        )
+        self.forget_account(account_id)
 
         if result.modified_count > 0:
             # SEND UPDATED DATA IN WEBHOOK
@@ -180,18 +298,18 @@ class AuthMixin:
 
     def link_telegram(self, account_id, telegram_id, display_name):
         telegram_id = str(telegram_id)
-        existing = self.db.accounts.find_one({"telegram_id": telegram_id, "_id": {"$ne": ObjectId(account_id)}})
-        if existing:
-            return False, "Telegram account already linked to another user."
-
         updates = {"telegram_id": telegram_id}
-        result = self.db.accounts.update_one(
-            {"_id": ObjectId(account_id)},
-            {
-                "$set": updates,
-                "$addToSet": {"auth_providers": "telegram"}
-            }
-        )
+        try:
+            result = self.db.accounts.update_one(
+                {"_id": to_object_id(account_id)},
+                {
+                    "$set": updates,
+                    "$addToSet": {"auth_providers": "telegram"}
+                }
+            )
+        except DuplicateKeyError:
+            return False, "Telegram account already linked to another user."
+        self.forget_account(account_id)
 
         if result.modified_count > 0:
             # SEND UPDATED DATA IN WEBHOOK
@@ -207,18 +325,20 @@ class AuthMixin:
     def update_account_profile(self, account_id, updates):
         if 'email' in updates:
             updates['email'] = updates['email'].lower()
-            existing = self.db.accounts.find_one({"email": updates['email'], "_id": {"$ne": ObjectId(account_id)}})
-            if existing:
-                return False, "Email is already in use by another account."
-
         if 'username' in updates:
             updates['username'] = updates['username'].lower()
-            existing = self.db.accounts.find_one(
-                {"username": updates['username'], "_id": {"$ne": ObjectId(account_id)}})
-            if existing:
-                return False, "Username is already taken."
 
-        result = self.db.accounts.update_one({"_id": ObjectId(account_id)}, {"$set": updates})
+        # Let the unique indexes reject collisions in the same round-trip as the write.
+        try:
+            result = self.db.accounts.update_one({"_id": to_object_id(account_id)}, {"$set": updates})
+        except DuplicateKeyError as e:
+            field = duplicate_field(e)
+            if field == 'username':
+                return False, "Username is already taken."
+            if field == 'email':
+                return False, "Email is already in use by another account."
+            return False, "Profile conflicts with another account."
+        self.forget_account(account_id)
 
         if result.matched_count > 0:
             # SEND UPDATED DATA IN WEBHOOK
@@ -1,75 +1,315 @@
-from pymongo import ASCENDING
-from zoneinfo import ZoneInfo
+from pymongo import ASCENDING, UpdateOne
+from pymongo.collation import Collation, CollationStrength
+from pymongo.errors import OperationFailure, PyMongoError
+from datetime import timedelta, timezone
+from functools import lru_cache
+import hashlib
 import logging
+import threading
 from bson import ObjectId
 from ..services.webhook_service import WebhookService
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
-UTC = ZoneInfo("UTC")
+UTC = timezone.utc
+
+# Case-insensitive compare for email/username. Queries must pass the same
+# collation as the index for Mongo to use it.
+CASE_INSENSITIVE = Collation(locale="en", strength=CollationStrength.SECONDARY)
+
+# Subscription plan lengths. 'lifetime' is handled by callers (expires_at: None).
+DURATION_TABLE = {
+    "1m": timedelta(days=30),
+    "3m": timedelta(days=90),
+    "6m": timedelta(days=180),
+    "1y": timedelta(days=365),
+}
+
+
+def _unique_partial(field, collation=None):
+    # Unique indexes over optional account fields. Partial (rather than sparse)
+    # indexes give the planner an explicit filter to match against and keep
+    # documents without the field out of the index.
+    options = {"unique": True, "partialFilterExpression": {field: {"$exists": True}}}
+    if collation:
+        options["collation"] = collation
+    return options
+
+
+# Every index Bifrost maintains: (collection, keys, create_index options).
+# Editing this list changes INDEX_FINGERPRINT, which makes the next process start
+# re-run index maintenance once.
+INDEX_SPECS = [
+    ("accounts", [("email", ASCENDING)], _unique_partial("email", CASE_INSENSITIVE)),
+    ("accounts", [("username", ASCENDING)], _unique_partial("username", CASE_INSENSITIVE)),
+    ("accounts", [("telegram_id", ASCENDING)], _unique_partial("telegram_id")),
+    ("accounts", [("google_id", ASCENDING)], _unique_partial("google_id")),
+    ("accounts", [("phone_number", ASCENDING)], _unique_partial("phone_number")),
+
+    # Standard non-sparse indexes
+    ("applications", [("client_id", ASCENDING)], {"unique": True}),
+    ("app_links", [("account_id", ASCENDING), ("app_id", ASCENDING)], {"unique": True}),
+    # App-scoped reads: get_app_users ($match on app_id), get_app_owner and the
+    # owner demotion in link_user_to_app (app_id + role)
+    ("app_links", [("app_id", ASCENDING), ("app_specific_role", ASCENDING)], {}),
+    # Account-scoped staff lookup: get_managed_apps (account_id + app_specific_role $in)
+    ("app_links", [("account_id", ASCENDING), ("app_specific_role", ASCENDING)], {}),
+    # Only links that can actually lapse; lifetime links (expires_at: None) stay out of the index
+    ("app_links", [("expires_at", ASCENDING)], {"partialFilterExpression": {"expires_at": {"$type": "date"}}}),
+    ("admins", [("email", ASCENDING)], {"unique": True}),
+    ("verification_codes", [("created_at", ASCENDING)], {"expireAfterSeconds": 600}),
+    # Query-shaped compounds: create_otp cleanup, verify_otp, verify_and_consume_code
+    ("verification_codes", [("identifier", ASCENDING), ("channel", ASCENDING)], {}),
+    ("verification_codes", [("code", ASCENDING), ("identifier", ASCENDING)], {}),
+    ("verification_codes", [("code", ASCENDING), ("channel", ASCENDING)], {}),
+
+    # Transactions
+    ("transactions", [("transaction_id", ASCENDING)], {"unique": True}),
+    ("transactions", [("account_id", ASCENDING)], {}),
+    ("transactions", [("app_id", ASCENDING)], {}),
+
+    # Payment Logs
+    ("payment_logs", [("trx_id", ASCENDING)], {"unique": True}),
+    ("payment_logs", [("status", ASCENDING)], {}),
+    # Claims match on the trailing digits of trx_id; storing it reversed turns
+    # that suffix match into an index-eligible anchored prefix match.
+    ("payment_logs", [("status", ASCENDING), ("trx_id_rev", ASCENDING)], {}),
+]
+
+
+def _fingerprint(specs):
+    canonical = [
+        (collection, keys, sorted(
+            (k, v.document if isinstance(v, Collation) else v) for k, v in options.items()
+        ))
+        for collection, keys, options in specs
+    ]
+    return hashlib.sha1(repr(canonical).encode()).hexdigest()
+
+
+INDEX_FINGERPRINT = _fingerprint(INDEX_SPECS)
+
+
+def _index_name(keys):
+    """Mongo's default index name for a key list, e.g. code_1_identifier_1."""
+    return "_".join(f"{field}_{direction}" for field, direction in keys)
+
+
+@lru_cache(maxsize=4096)
+def _parse_object_id(value):
+    return ObjectId(value)
+
+
+def to_object_id(value):
+    """
+    Converts an id (str or ObjectId) to an ObjectId.
+    Hex parsing is memoized since the same account/app ids recur across a request.
+    """
+    if isinstance(value, ObjectId):
+        return value
+    return _parse_object_id(value)
+
+
+def strip_whitespace(value):
+    """
+    Removes all whitespace from user-typed codes/ids, including Unicode spaces
+    (NBSP, thin space) that mail and chat clients insert when codes are pasted.
+    """
+    if not value:
+        return None
+    if not isinstance(value, str):
+        value = str(value)
+    # Fast path: most codes arrive clean. The ASCII space is the only whitespace
+    # character isprintable() accepts, so everything else takes the split() path.
+    if value.isprintable() and " " not in value:
+        return value
+    return "".join(value.split())
+
+
+def _index_matches(spec, keys, options):
+    """True if an index_information() entry already satisfies the requested index."""
+    if list(spec.get('key', [])) != list(keys):
+        return False
+    for flag in ('unique', 'sparse'):
+        if bool(spec.get(flag)) != bool(options.get(flag)):
+            return False
+    for opt in ('expireAfterSeconds', 'partialFilterExpression'):
+        if spec.get(opt) != options.get(opt):
+            return False
+    return _collation_matches(spec.get('collation'), options.get('collation'))
+
+
+def _collation_matches(existing, wanted):
+    """Compares an index_information() collation dict with a Collation (or None)."""
+    if wanted is None:
+        return not existing
+    if not existing:
+        return False
+    doc = wanted.document
+    return all(existing.get(k) == v for k, v in doc.items())
+
 
 class BaseMixin:
+    # Databases whose indexes this process has already ensured. BifrostDB is
+    # instantiated per request, so index maintenance must not run every time.
+    _indexes_ready = set()
+    _indexes_lock = threading.Lock()
+
     def __init__(self, mongo_client, db_name):
         self.db = mongo_client[db_name]
         self.init_indexes()
 
     def init_indexes(self):
-        """Creates unique indexes to enforce data integrity."""
-        # Helper to ensure unique sparse index
-        def ensure_unique_sparse(collection, field):
-            idx_name = f"{field}_1"
+        """
+        Ensures indexes once per process and database; later calls are no-ops.
+        Across processes, a fingerprint of INDEX_SPECS stored in `_meta` lets a
+        fresh worker skip maintenance, provided every index it names still exists
+        (a dropped or restored collection would otherwise break the OTP hints).
+        """
+        key = self.db.name
+        if key in BaseMixin._indexes_ready:
+            return
+        with BaseMixin._indexes_lock:
+            if key in BaseMixin._indexes_ready:
+                return
+            # Maintenance must never fail the request (or the bot) that happens to
+            # construct BifrostDB first; it is retried on the next construction.
             try:
-                collection.create_index([(field, ASCENDING)], unique=True, sparse=True)
-            except Exception:
+                meta = self.db["_meta"].find_one({"_id": "index_fingerprint"})
+                current = meta and meta.get("value") == INDEX_FINGERPRINT
+                ready = current and self._indexes_present()
+                if not ready:
+                    ready = self._ensure_indexes()
+                    # Only record the fingerprint once every index went through, so a
+                    # failed build is retried by the next process
+                    if ready:
+                        self.db["_meta"].replace_one(
+                            {"_id": "index_fingerprint"},
+                            {"_id": "index_fingerprint", "value": INDEX_FINGERPRINT},
+                            upsert=True
+                        )
+            except PyMongoError as e:
+                log.warning(f"Index maintenance on {key} skipped, will retry: {e}")
+                return
+            # A partial build is retried on this process's next construction too
+            if ready:
+                BaseMixin._indexes_ready.add(key)
+
+    def _indexes_present(self):
+        """True if every INDEX_SPECS index exists by name (one list_indexes per collection)."""
+        wanted = {}
+        for collection_name, keys, _ in INDEX_SPECS:
+            wanted.setdefault(collection_name, set()).add(_index_name(keys))
+        for collection_name, names in wanted.items():
+            existing = {index["name"] for index in self.db[collection_name].list_indexes()}
+            if not names <= existing:
+                log.info(f"Indexes missing on {collection_name}: {sorted(names - existing)}")
+                return False
+        return True
+
+    def _ensure_indexes(self):
+        """
+        Creates indexes to enforce data integrity.
+        Reads the existing index list once per collection and only creates what is
+        missing; an index is dropped only when its options genuinely conflict.
+        Returns False if any index could not be created.
+        """
+        existing_indexes = {}
+        failed = []
+
+        def indexes_of(collection):
+            if collection.name not in existing_indexes:
+                existing_indexes[collection.name] = collection.index_information()
+            return existing_indexes[collection.name]
+
+        def ensure_index(collection, keys, **options):
+            idx_name = _index_name(keys)
+
+            try:
+                spec = indexes_of(collection).get(idx_name)
+                if spec and _index_matches(spec, keys, options):
+                    return
+                collection.create_index(keys, **options)
+            except OperationFailure as e:
+                # 85/86: an index with this name/key exists with different options
+                # (e.g. the legacy sparse variant) -> replace it.
+                if e.code not in (85, 86):
+                    log.warning(f"Could not create index {idx_name} on {collection.name}: {e}")
+                    failed.append(idx_name)
+                    return
                 try:
-                    log.info(f"Recreating index for {field} to ensure sparse constraint...")
+                    log.info(f"Recreating index {idx_name} on {collection.name} with updated options...")
                     collection.drop_index(idx_name)
-                    collection.create_index([(field, ASCENDING)], unique=True, sparse=True)
-                except Exception as e:
-                    log.warning(f"Could not recreate sparse index for {field}: {e}")
-
-        # Ensure sparse indexes for optional fields
-        ensure_unique_sparse(self.db.accounts, "email")
-        ensure_unique_sparse(self.db.accounts, "username")
-        ensure_unique_sparse(self.db.accounts, "telegram_id")
-        ensure_unique_sparse(self.db.accounts, "google_id")
-        ensure_unique_sparse(self.db.accounts, "phone_number")
-
-        # Standard non-sparse indexes
-        self.db.applications.create_index([("client_id", ASCENDING)], unique=True)
-        self.db.app_links.create_index([("account_id", ASCENDING), ("app_id", ASCENDING)], unique=True)
-        self.db.admins.create_index([("email", ASCENDING)], unique=True)
-        self.db.verification_codes.create_index("created_at", expireAfterSeconds=600)
-        self.db.verification_codes.create_index([("identifier", ASCENDING)])
-
-        # Transactions
-        self.db.transactions.create_index([("transaction_id", ASCENDING)], unique=True)
-        self.db.transactions.create_index([("account_id", ASCENDING)])
-        self.db.transactions.create_index([("app_id", ASCENDING)])
-
-        # Payment Logs
-        self.db.payment_logs.create_index([("trx_id", ASCENDING)], unique=True)
-        self.db.payment_logs.create_index([("status", ASCENDING)])
+                    collection.create_index(keys, **options)
+                except PyMongoError as e:
+                    log.warning(f"Could not recreate index {idx_name} on {collection.name}: {e}")
+                    failed.append(idx_name)
+            except PyMongoError as e:
+                # e.g. NetworkTimeout while a large build outlives socketTimeoutMS
+                log.warning(f"Could not create index {idx_name} on {collection.name}: {e}")
+                failed.append(idx_name)
+
+        for collection_name, keys, options in INDEX_SPECS:
+            ensure_index(self.db[collection_name], keys, **options)
+
+        # The old single-field identifier index is a prefix of the (identifier, channel) compound.
+        # Another process (web worker or bot) may drop it first: 27 = IndexNotFound.
+        try:
+            if "identifier_1" in indexes_of(self.db.verification_codes):
+                self.db.verification_codes.drop_index("identifier_1")
+        except OperationFailure as e:
+            if e.code != 27:
+                log.warning(f"Could not drop legacy index identifier_1: {e}")
+                failed.append("identifier_1")
+        except PyMongoError as e:
+            log.warning(f"Could not drop legacy index identifier_1: {e}")
+            failed.append("identifier_1")
+
+        try:
+            self._backfill_trx_id_rev()
+        except PyMongoError as e:
+            log.warning(f"trx_id_rev backfill failed, will retry: {e}")
+            failed.append("trx_id_rev")
+        return not failed
+
+    def _backfill_trx_id_rev(self):
+        """One-off: adds trx_id_rev to unclaimed payment logs written before it existed."""
+        legacy = self.db.payment_logs.find(
+            {"status": "unclaimed", "trx_id_rev": None, "trx_id": {"$type": "string"}},
+            {"trx_id": 1}
+        )
+        ops = [UpdateOne({"_id": doc['_id']}, {"$set": {"trx_id_rev": doc['trx_id'][::-1]}}) for doc in legacy]
+        if ops:
+            self.db.payment_logs.bulk_write(ops, ordered=False)
+            log.info(f"Backfilled trx_id_rev on {len(ops)} unclaimed payment logs.")
 
     def _trigger_event_for_user(self, account_id, event_type, specific_app_id=None, token=None, extra_data=None):
         """
         Finds linked apps for a user and triggers the webhook.
         """
         try:
-            query = {"account_id": ObjectId(account_id)}
+            query = {"account_id": to_object_id(account_id)}
             if specific_app_id:
-                query["app_id"] = ObjectId(specific_app_id)
-
-            links = list(self.db.app_links.find(query))
-            if not links:
-                return
+                query["app_id"] = to_object_id(specific_app_id)
 
-            app_ids = list(set([link['app_id'] for link in links]))
-            apps = self.db.applications.find({"_id": {"$in": app_ids}})
+            # One round-trip: join links to their apps server-side and only ship
+            # the fields WebhookService.send_event reads.
+            apps = self.db.app_links.aggregate([
+                {"$match": query},
+                {"$lookup": {
+                    "from": "applications",
+                    "localField": "app_id",
+                    "foreignField": "_id",
+                    "as": "app"
+                }},
+                {"$unwind": "$app"},
+                {"$replaceRoot": {"newRoot": "$app"}},
+                {"$project": {"app_api_url": 1, "client_id": 1, "webhook_secret": 1}}
+            ])
 
             for app_doc in apps:
-                # Trigger the webhook (WebhookService handles the signing)
-                WebhookService.send_event(
+                # Queue the webhook (WebhookService handles the signing and delivery)
+                WebhookService.send_event_async(
                     app_doc=app_doc,
                     event_type=event_type,
                     account_id=account_id,
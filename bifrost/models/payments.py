@@ -1,12 +1,18 @@
 # bifrost/models/payment.py
+import re
 import secrets
-from datetime import datetime, timedelta
-from zoneinfo import ZoneInfo
-from bson import ObjectId
+from datetime import datetime, timezone
+from bson import Regex
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from .base import to_object_id, strip_whitespace, DURATION_TABLE
 import logging
 
 log = logging.getLogger(__name__)
-UTC = ZoneInfo("UTC")
+UTC = timezone.utc
+
+# Bank Trx IDs are numeric; users may type just the trailing digits.
+TRX_INPUT_PATTERN = re.compile(r"\d{4,32}")
 
 
 class PaymentMixin:
@@ -17,14 +23,15 @@ class PaymentMixin:
                            duration="1m", client_ref_id=None, app_name=None):
         """Creates a pending transaction record."""
         tx_id = f"tx-{secrets.token_hex(8)}"
+        now = datetime.now(UTC)
 
         # Handle account_id being None (for pre-login intents)
-        acc_oid = ObjectId(account_id) if account_id else None
+        acc_oid = to_object_id(account_id) if account_id else None
 
         tx_doc = {
             "transaction_id": tx_id,
             "account_id": acc_oid,
-            "app_id": ObjectId(app_id),
+            "app_id": to_object_id(app_id),
             "app_name": app_name,
             "amount": amount,
             "currency": currency,
@@ -33,8 +40,8 @@ class PaymentMixin:
             "target_role": target_role,
             "duration": duration,
             "client_ref_id": client_ref_id,
-            "created_at": datetime.now(UTC),
-            "updated_at": datetime.now(UTC),
+            "created_at": now,
+            "updated_at": now,
             "provider_ref": None
         }
         self.db.transactions.insert_one(tx_doc)
@@ -49,40 +56,32 @@ class PaymentMixin:
         STRICT MODE: Writes ONLY to 'app_specific_role'.
         Legacy 'role' field is completely deprecated.
         """
-        tx = self.db.transactions.find_one({"transaction_id": transaction_id})
-        if not tx:
-            return False, "Transaction not found"
-
-        if tx['status'] == 'completed':
-            return True, "Already completed"
+        now = datetime.now(UTC)
 
         # 1. Update Transaction Status
-        self.db.transactions.update_one(
-            {"_id": tx['_id']},
+        # Atomic claim: only the caller that flips the status grants the role,
+        # so concurrent provider callbacks can't double-apply it.
+        tx = self.db.transactions.find_one_and_update(
+            {"transaction_id": transaction_id, "status": {"$ne": "completed"}},
             {
                 "$set": {
                     "status": "completed",
                     "provider_ref": provider_ref,
-                    "updated_at": datetime.now(UTC)
+                    "updated_at": now
                 }
-            }
+            },
+            projection={"account_id": 1, "app_id": 1, "duration": 1, "target_role": 1},
+            return_document=ReturnDocument.BEFORE
         )
+        if not tx:
+            if self.db.transactions.find_one({"transaction_id": transaction_id}, {"_id": 1}):
+                return True, "Already completed"
+            return False, "Transaction not found"
 
         # 2. Calculate Expiration
         duration = tx.get('duration')
-        expires_at = None
-        if duration:
-            now = datetime.now(UTC)
-            if duration == '1m':
-                expires_at = now + timedelta(days=30)
-            elif duration == '3m':
-                expires_at = now + timedelta(days=90)
-            elif duration == '6m':
-                expires_at = now + timedelta(days=180)
-            elif duration == '1y':
-                expires_at = now + timedelta(days=365)
-            elif duration == 'lifetime':
-                expires_at = None
+        delta = DURATION_TABLE.get(duration)
+        expires_at = now + delta if delta is not None else None
 
         # 3. Grant Role (STRICT)
         # We exclusively use 'app_specific_role' for ALL apps.
@@ -90,7 +89,7 @@ class PaymentMixin:
 
         update_doc = {
             "app_specific_role": target_role,
-            "last_login": datetime.now(UTC)
+            "last_login": now
         }
 
         if expires_at:
@@ -107,7 +106,7 @@ class PaymentMixin:
             },
             {
                 "$set": update_doc,
-                "$setOnInsert": {"linked_at": datetime.now(UTC)}
+                "$setOnInsert": {"linked_at": now}
                 # NOTE: We intentionally DO NOT set "role": "user" here anymore.
             },
             upsert=True
@@ -125,12 +124,14 @@ class PaymentMixin:
         }
 
     def save_pending_payment(self, trx_id, amount, currency, raw_text, payer_name):
+        """
+        Stores a payment log. Returns True when stored, False if the trx_id already
+        exists or the log could not be saved.
+        """
         try:
-            if self.db.payment_logs.find_one({"trx_id": trx_id}):
-                return False
-
-            self.db.payment_logs.insert_one({
+            doc = {
                 "trx_id": trx_id,
+                "trx_id_rev": trx_id[::-1],
                 "amount": float(amount),
                 "currency": currency,
                 "payer_name": payer_name,
@@ -138,47 +139,56 @@ class PaymentMixin:
                 "status": "unclaimed",
                 "claimed_by_account_id": None,
                 "created_at": datetime.now(UTC)
-            })
+            }
+            # The unique trx_id index rejects duplicates; no find_one pre-check
+            self.db.payment_logs.insert_one(doc)
             return True
+        except DuplicateKeyError:
+            return False
         except Exception as e:
             log.error(f"Error saving payment log: {e}")
             return False
 
     def claim_payment(self, trx_input, app_id, user_identity):
-        # 1. Resolve User
+        # 1. Resolve User (only the _id is needed below)
         user = None
+        id_only = {"_id": 1}
         if 'account_id' in user_identity:
-            user = self.find_account_by_id(user_identity['account_id'])
+            user = self.find_account_by_id(user_identity['account_id'], projection=id_only)
         elif 'telegram_id' in user_identity:
-            user = self.find_account_by_telegram(user_identity['telegram_id'])
+            user = self.find_account_by_telegram(user_identity['telegram_id'], projection=id_only)
         elif 'email' in user_identity:
-            user = self.find_account_by_email(user_identity['email'])
+            user = self.find_account_by_email(user_identity['email'], projection=id_only)
 
         if not user:
             return False, "User account not found."
 
         # 2. Fuzzy Match Payment
-        safe_input = str(trx_input).strip()
-        regex_pattern = f"{safe_input}$"
+        safe_input = strip_whitespace(trx_input) or ""
+        if not TRX_INPUT_PATTERN.fullmatch(safe_input):
+            return False, "Invalid Transaction ID format."
 
+        # Suffix match on trx_id == anchored prefix match on the reversed copy (indexed)
         payment = self.db.payment_logs.find_one({
             "status": "unclaimed",
-            "trx_id": {"$regex": regex_pattern}
+            "trx_id_rev": Regex(f"^{re.escape(safe_input[::-1])}")
         })
 
         if not payment:
             return False, "Transaction ID not found or already claimed."
 
         # 3. Atomic Claim
+        now = datetime.now(UTC)
+        app_oid = to_object_id(app_id)
         result = self.db.payment_logs.update_one(
             {"_id": payment['_id'], "status": "unclaimed"},
             {
                 "$set": {
                     "status": "claimed",
                     "claimed_by_account_id": user['_id'],
-                    "claimed_for_app_id": ObjectId(app_id),
+                    "claimed_for_app_id": app_oid,
                     "claimed_method": list(user_identity.keys())[0],
-                    "claimed_at": datetime.now(UTC)
+                    "claimed_at": now
                 }
             }
         )
@@ -187,7 +197,16 @@ class PaymentMixin:
             return False, "Error: Payment claimed by someone else."
 
         # 4. Grant Premium Role (Claims currently default to 1 Month if not specified)
-        self.link_user_to_app(user['_id'], app_id, role="premium_user", suppress_webhook=True)
+        # Direct upsert: the role-change webhook is suppressed here, so link_user_to_app's
+        # old-role read would be a wasted round-trip.
+        self.db.app_links.update_one(
+            {"account_id": user['_id'], "app_id": app_oid},
+            {
+                "$set": {"app_specific_role": "premium_user", "last_login": now},
+                "$setOnInsert": {"linked_at": now}
+            },
+            upsert=True
+        )
 
         # 5. Send Success Webhook for Claims
         self._trigger_event_for_user(
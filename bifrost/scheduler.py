@@ -1,14 +1,13 @@
 import time
 import schedule
 import logging
-from datetime import datetime
-from zoneinfo import ZoneInfo
-from bson import ObjectId
+from datetime import datetime, timezone
+from pymongo import ReturnDocument
 from .models import BifrostDB
 from . import mongo
 
 log = logging.getLogger("bifrost_reaper")
-UTC = ZoneInfo("UTC")
+UTC = timezone.utc
 
 def run_expiration_check(app):
     """
@@ -20,35 +19,36 @@ def run_expiration_check(app):
         now = datetime.now(UTC)
 
         # Find all links that are NOT 'user' (premium/admin) AND have expired
+        # STRICT: roles live in app_specific_role only
         query = {
-            "role": {"$ne": "user"},
+            "app_specific_role": {"$ne": "user"},
             "expires_at": {"$lt": now}
         }
 
-        expired_links = list(db.db.app_links.find(query))
-
-        if not expired_links:
-            log.info("🌾 Reaper: No expired subscriptions found.")
-            return
-
-        log.info(f"🌾 Reaper: Found {len(expired_links)} expired subscriptions. Processing...")
-
-        for link in expired_links:
-            user_id = link['account_id']
-            app_id = link['app_id']
-            old_role = link.get('role', 'unknown')
-
-            # 1. Downgrade in DB
-            db.db.app_links.update_one(
-                {"_id": link['_id']},
+        # Claim one lapsed link at a time: the atomic update returns the pre-image only
+        # for links it actually downgraded, so a link renewed after the job started is
+        # neither touched nor reported.
+        expired_count = 0
+        while True:
+            link = db.db.app_links.find_one_and_update(
+                query,
                 {
-                    "$set": {"role": "user"},
+                    "$set": {"app_specific_role": "user"},
                     "$unset": {"expires_at": ""} # Clear expiration since they are now free
-                }
+                },
+                projection={"account_id": 1, "app_id": 1, "app_specific_role": 1},
+                return_document=ReturnDocument.BEFORE
             )
+            if not link:
+                break
+            expired_count += 1
 
-            # 2. Trigger Specific Expiration Webhook
-            log.info(f"⬇️ Downgrading User {user_id} for App {app_id}")
+            user_id = link['account_id']
+            app_id = link['app_id']
+            old_role = link.get('app_specific_role', 'unknown')
+
+            # Trigger Specific Expiration Webhook
+            log.info(f"⬇️ Downgraded User {user_id} for App {app_id}")
             db._trigger_event_for_user(
                 account_id=user_id,
                 event_type="subscription_expired",
@@ -60,6 +60,11 @@ def run_expiration_check(app):
                 }
             )
 
+        if not expired_count:
+            log.info("🌾 Reaper: No expired subscriptions found.")
+        else:
+            log.info(f"🌾 Reaper: Downgraded {expired_count} expired subscriptions.")
+
 def start_scheduler(app):
     """Starts the scheduler in a background thread."""
     import threading
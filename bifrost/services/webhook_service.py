@@ -3,12 +3,33 @@ import requests
 import hmac
 import hashlib
 import json
+from concurrent.futures import ThreadPoolExecutor
 from flask import current_app
 from datetime import datetime
 
 log = logging.getLogger(__name__)
 
+# Webhook delivery is outbound HTTP; keep it off the request thread.
+_WEBHOOK_POOL = ThreadPoolExecutor(max_workers=16, thread_name_prefix="bifrost-webhook")
+
+
 class WebhookService:
+    @staticmethod
+    def send_event_async(**kwargs):
+        """
+        Queues send_event on the webhook pool and returns immediately.
+        Takes the same keyword arguments as send_event.
+        """
+        return _WEBHOOK_POOL.submit(WebhookService._send_event_logged, **kwargs)
+
+    @staticmethod
+    def _send_event_logged(**kwargs):
+        # Exceptions inside a Future are otherwise never seen
+        try:
+            WebhookService.send_event(**kwargs)
+        except Exception as e:
+            log.error(f"🪝 Webhook dispatch crashed for {kwargs.get('event_type')}: {e}")
+
     @staticmethod
     def send_event(app_doc, event_type, account_id, token=None, extra_data=None):
         """
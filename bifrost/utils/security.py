@@ -0,0 +1,128 @@
+# bifrost/utils/security.py
+
+import os
+import hmac
+import time
+import hashlib
+import logging
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.security import generate_password_hash, check_password_hash
+
+log = logging.getLogger(__name__)
+
+# KDF work (scrypt/pbkdf2) is CPU-bound and takes tens of ms per call.
+# Running it on a bounded pool keeps concurrent logins from oversubscribing
+# the CPU and leaves the calling worker free to be scheduled elsewhere.
+_HASH_POOL = ThreadPoolExecutor(max_workers=os.cpu_count() or 4, thread_name_prefix="bifrost-hash")
+
+# Werkzeug method string for new hashes, e.g. "scrypt" (werkzeug's default,
+# n=2**15), "scrypt:65536:8:1" or "pbkdf2:sha256:1000000". Set from
+# config.PASSWORD_HASH_METHOD by create_app(); raise the cost there over time and
+# stored hashes are upgraded on the next successful login.
+PASSWORD_HASH_METHOD = 'scrypt'
+
+
+# App client secrets are 256-bit random tokens, so a slow KDF adds CPU and no
+# security; a keyed HMAC is enough. The pepper never leaves the server, is
+# mandatory and set from config.CLIENT_SECRET_PEPPER by create_app().
+# Changing it invalidates every stored client secret.
+_CLIENT_SECRET_PEPPER = None
+_CLIENT_SECRET_PREFIX = "hmac-sha256$"
+
+# OTP codes and deep-link tokens are stored as a keyed hash, so reading the
+# verification_codes collection doesn't reveal live codes. Without a secret key a
+# 6-digit code's hash falls to trying all 900k codes, so the pepper is mandatory
+# and set from config.OTP_PEPPER by create_app(). Changing it only voids the codes
+# in flight (they expire after 10 minutes anyway).
+_OTP_PEPPER = None
+
+
+def hash_password(password):
+    """Hashes a password (or client secret) on the hashing pool."""
+    return _HASH_POOL.submit(generate_password_hash, password, PASSWORD_HASH_METHOD).result()
+
+
+def check_password(pwhash, password):
+    """Verifies a password against a stored hash on the hashing pool."""
+    return _HASH_POOL.submit(check_password_hash, pwhash, password).result()
+
+
+def hash_client_secret(secret):
+    """Keyed hash for app client secrets (not for user passwords)."""
+    if _CLIENT_SECRET_PEPPER is None:
+        raise RuntimeError("Client secret pepper not configured; call set_client_secret_pepper() at startup.")
+    digest = hmac.new(_CLIENT_SECRET_PEPPER, secret.encode(), hashlib.sha256).hexdigest()
+    return _CLIENT_SECRET_PREFIX + digest
+
+
+def is_client_secret_hash(secret_hash):
+    """False for legacy werkzeug KDF hashes, which verify_client_secret migrates on use."""
+    return bool(secret_hash) and secret_hash.startswith(_CLIENT_SECRET_PREFIX)
+
+
+def check_client_secret(secret_hash, secret):
+    """Constant-time check of a client secret against hash_client_secret() output."""
+    return hmac.compare_digest(secret_hash, hash_client_secret(secret))
+
+
+def set_password_hash_method(method):
+    """Installs the werkzeug method string for new password hashes; called once at startup."""
+    global PASSWORD_HASH_METHOD
+    PASSWORD_HASH_METHOD = method or 'scrypt'
+    _current_method_prefix.cache_clear()
+
+
+def set_client_secret_pepper(pepper):
+    """Installs the client secret hashing key; called once at startup."""
+    global _CLIENT_SECRET_PEPPER
+    if not pepper:
+        raise RuntimeError("CRITICAL: Missing CLIENT_SECRET_PEPPER for client secret hashing.")
+    _CLIENT_SECRET_PEPPER = pepper.encode() if isinstance(pepper, str) else pepper
+
+
+def set_otp_pepper(pepper):
+    """Installs the OTP hashing key; called once at startup."""
+    global _OTP_PEPPER
+    if not pepper:
+        raise RuntimeError("CRITICAL: Missing OTP_PEPPER (or SECRET_KEY) for OTP hashing.")
+    _OTP_PEPPER = pepper.encode() if isinstance(pepper, str) else pepper
+
+
+def hash_otp(code):
+    """Fixed-length keyed hash stored (and looked up) in place of an OTP code or token."""
+    if _OTP_PEPPER is None:
+        raise RuntimeError("OTP pepper not configured; call set_otp_pepper() at startup.")
+    return hmac.new(_OTP_PEPPER, code.encode(), hashlib.sha256).hexdigest()
+
+
+@lru_cache(maxsize=1)
+def _current_method_prefix():
+    # "scrypt" expands to "scrypt:32768:8:1" in the stored hash; hash once to learn the canonical form
+    return generate_password_hash("", PASSWORD_HASH_METHOD).split("$", 1)[0]
+
+
+def needs_rehash(pwhash):
+    """True if `pwhash` was produced with a different method or cost than PASSWORD_HASH_METHOD."""
+    return bool(pwhash) and pwhash.split("$", 1)[0] != _current_method_prefix()
+
+
+def calibrate_hash_method(target_seconds=0.25, max_log2_n=16):
+    """
+    Picks the cheapest scrypt cost that takes at least `target_seconds` on this CPU
+    and returns it as a werkzeug method string for PASSWORD_HASH_METHOD.
+    Run once per deployment target, not at startup: hosts that disagree on the
+    cost would keep re-hashing each other's logins via needs_rehash().
+    scrypt memory is 128 * n * r bytes per hash (64 MiB at n=2**16), times the
+    hashing pool size, hence the cap on n.
+
+        python -c "from bifrost.utils.security import calibrate_hash_method as c; print(c())"
+    """
+    method = "scrypt:32768:8:1"
+    for log2_n in range(14, max_log2_n + 1):
+        method = f"scrypt:{2 ** log2_n}:8:1"
+        started = time.perf_counter()
+        generate_password_hash("calibration", method)
+        if time.perf_counter() - started >= target_seconds:
+            break
+    return method
@@ -1,7 +1,13 @@
 from pymongo import MongoClient
+from bifrost.models import MONGO_CLIENT_OPTIONS
 from .config import Config
 
+_client = None
+
+
 def get_db():
-    """Returns a MongoDB Database instance."""
-    client = MongoClient(Config.MONGO_URI)
-    return client[Config.DB_NAME]
\ No newline at end of file
+    """Returns a MongoDB Database instance backed by one shared, pooled client."""
+    global _client
+    if _client is None:
+        _client = MongoClient(Config.MONGO_URI, **MONGO_CLIENT_OPTIONS)
+    return _client[Config.DB_NAME]
\ No newline at end of file
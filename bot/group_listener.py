@@ -3,6 +3,7 @@ import re
 from telegram import Update
 from telegram.ext import ContextTypes
 from pymongo import MongoClient
+from bifrost.models import MONGO_CLIENT_OPTIONS
 from datetime import datetime
 
 # Central Config
@@ -16,9 +17,15 @@ ABA_PATTERN = re.compile(
 
 logger = logging.getLogger("bifrost-listener")
 
+_client = None
+
+
 def get_db():
-    client = MongoClient(Config.MONGO_URI)
-    return client[Config.DB_NAME]
+    # One pooled client per process; a new MongoClient per message opens a new pool
+    global _client
+    if _client is None:
+        _client = MongoClient(Config.MONGO_URI, **MONGO_CLIENT_OPTIONS)
+    return _client[Config.DB_NAME]
 
 async def aba_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Listens to messages in the Payment Group."""
@@ -42,10 +49,11 @@ async def aba_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
 
         try:
             db = get_db()
-            exists = db.payment_logs.find_one({"trx_id": trx_id})
+            exists = db.payment_logs.find_one({"trx_id": trx_id}, {"_id": 1})
             if not exists:
                 db.payment_logs.insert_one({
                     "trx_id": trx_id,
+                    "trx_id_rev": trx_id[::-1],
                     "amount": float(amount_str),
                     "currency": "USD",
                     "payer_name": payer_name,
@@ -29,7 +29,7 @@ def check_admin_permission(telegram_id, client_id):
         logic = BifrostDB(db_instance.client, Config.DB_NAME)
 
         # 1. Resolve User
-        user = logic.find_account_by_telegram(telegram_id)
+        user = logic.find_account_by_telegram(telegram_id, fresh=True)
         if not user:
             return False
 
@@ -71,11 +71,11 @@ def call_grant_premium(user_identifier, target_client_id):
             # Basic hex validation
             import re
             if re.match(r'^[0-9a-fA-F]{24}$', user_identifier):
-                user = logic.find_account_by_id(user_identifier)
+                user = logic.find_account_by_id(user_identifier, fresh=True)
 
         # Case B: If not found or not ObjectId, try Telegram ID
         if not user:
-            user = logic.find_account_by_telegram(user_identifier)
+            user = logic.find_account_by_telegram(user_identifier, fresh=True)
 
         if not user:
             log.error(f"User identifier '{user_identifier}' not found in DB.")
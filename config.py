@@ -7,7 +7,15 @@ class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY')
     MONGO_URI = os.environ.get('MONGO_URI')
     DB_NAME = os.environ.get('DB_NAME', 'bifrost_db')
+    MONGO_MAX_POOL_SIZE = int(os.environ.get('MONGO_MAX_POOL_SIZE', 200))
+    MONGO_MIN_POOL_SIZE = int(os.environ.get('MONGO_MIN_POOL_SIZE', 10))
     JWT_SECRET_KEY = os.environ.get('JWT_SECRET_KEY')
+    # Key for the stored OTP/deep-link hashes. Falls back to SECRET_KEY, which is required below.
+    OTP_PEPPER = os.environ.get('OTP_PEPPER') or SECRET_KEY
+    # Key for the stored app client secret hashes. Changing it invalidates every client secret.
+    CLIENT_SECRET_PEPPER = os.environ.get('CLIENT_SECRET_PEPPER')
+    # Werkzeug method for new password hashes, e.g. "scrypt:65536:8:1" (see calibrate_hash_method)
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt')
 
     # --- EMAIL SETTINGS ---
     EMAIL_PASSWORD = os.environ.get('EMAIL_PASSWORD')
@@ -28,5 +36,5 @@ class Config:
     GUMROAD_PRODUCT_PERMALINK = os.environ.get('GUMROAD_PRODUCT_PERMALINK')
     GUMROAD_BASE_URL = "https://gumroad.com/l"
 
-    if not SECRET_KEY or not MONGO_URI or not JWT_SECRET_KEY or not EMAIL_PASSWORD:
-        raise RuntimeError("CRITICAL: Missing .env keys (EMAIL_PASSWORD, SECRET_KEY, etc.)")
\ No newline at end of file
+    if not SECRET_KEY or not MONGO_URI or not JWT_SECRET_KEY or not EMAIL_PASSWORD or not CLIENT_SECRET_PEPPER:
+        raise RuntimeError("CRITICAL: Missing .env keys (EMAIL_PASSWORD, SECRET_KEY, CLIENT_SECRET_PEPPER, etc.)")
\ No newline at end of file